@@ -3,103 +3,801 @@
 
 
 # ================================================================================================= Imports
+import ctypes
+import itertools
+import logging
+import mmap
+import os
 import select
 import socket
-from queue import Queue
-from threading import Thread
-from typing import Callable
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from errno import EAGAIN, EINTR, EIO, EWOULDBLOCK
+from threading import Lock, Thread
 
-from bencode import bencode
+# fast-bencode ships a compiled encoder, but its package silently falls back to a pure-Python one
+#   if the extension could not be built. Import the compiled one directly so that the fallback,
+#   which is far too slow for the send path, can be reported.
+try:
+	from bencode._bencode import BTFailure, bdecode, bencode
+	BENCODE_NATIVE:bool = True
+except ImportError:
+	from bencode import bdecode, bencode
+	from bencode.BTL import BTFailure
+	BENCODE_NATIVE = False
 
 
 
 # ================================================================================================= Global Variables
 PORT:int = 6881
-SOCK_RECV_BUF_SIZE:int = 1024
+SOCK_RECV_BUF_SIZE:int = 1500
+SOCK_KERNEL_BUF_SIZE:int = 8 * 1024 * 1024  # The requested kernel send and receive buffer sizes for the main socket.
+SEND_BATCH_SIZE:int = 64  # The maximum number of datagrams handed to a single sendmmsg() call.
+SEND_SLOT_SIZE:int = 1500  # The largest bencoded Message that can be sent, to stay within a typical MTU.
+RECV_BATCH_SIZE:int = 32  # The maximum number of datagrams read by a single recvmmsg() call.
+RECV_MAX_BATCHES:int = 8  # The most recvmmsg() calls made per wakeup, so that receiving can't starve sending.
+PROCESS_BATCH_SIZE:int = 16  # The number of received datagrams handed to a processing thread at once.
+RECV_SLOT_COUNT:int = 1024  # The number of receive buffers. Datagrams are dropped while they are all in use.
+GSO_MAX_SEGMENTS:int = 64  # The kernel's UDP_MAX_SEGMENTS limit on datagrams per segmented send.
+GSO_MAX_BYTES:int = 65000  # The most data handed to one segmented send, which must fit in a single IP packet.
+SEND_RING_SIZE:int = 4096  # The number of datagrams that can be queued for sending, enough for a large burst. Must be a power of two.
+
+
+
+# ================================================================================================= Native Bindings
+# The batched datagram syscalls are not exposed by the socket module, so they are called through
+#   libc directly. The structures below mirror the Linux definitions in <sys/socket.h>,
+#   <sys/uio.h> and <netinet/in.h>.
+libc:ctypes.CDLL = ctypes.CDLL(None, use_errno=True)
+
+
+class Iovec(ctypes.Structure):
+	_fields_ = [
+		('iov_base', ctypes.c_void_p),
+		('iov_len', ctypes.c_size_t),
+	]
+
+
+class SockaddrIn(ctypes.Structure):
+	_fields_ = [
+		('sin_family', ctypes.c_uint16),
+		('sin_port', ctypes.c_uint16),  # Network byte order.
+		('sin_addr', ctypes.c_ubyte * 4),  # Network byte order.
+		('sin_zero', ctypes.c_ubyte * 8),
+	]
+
+
+class MsgHdr(ctypes.Structure):
+	_fields_ = [
+		('msg_name', ctypes.c_void_p),
+		('msg_namelen', ctypes.c_uint32),
+		('msg_iov', ctypes.POINTER(Iovec)),
+		('msg_iovlen', ctypes.c_size_t),
+		('msg_control', ctypes.c_void_p),
+		('msg_controllen', ctypes.c_size_t),
+		('msg_flags', ctypes.c_int),
+	]
+
+
+class MMsgHdr(ctypes.Structure):
+	_fields_ = [
+		('msg_hdr', MsgHdr),
+		('msg_len', ctypes.c_uint),
+	]
+
+
+# The UDP_SEGMENT socket option (generic segmentation offload, Linux 4.18+) from <linux/udp.h>,
+#   which the socket module does not define.
+UDP_SEGMENT:int = 103
+
+libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+libc.sendmmsg.restype = ctypes.c_int
+libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+libc.recvmmsg.restype = ctypes.c_int
+
+
+
+# ================================================================================================= Encoding
+# Without the compiled encoder, bencode() builds a list of fragments and joins them into a new bytes
+#   object, which the send ring then copies again. bencodeInto() instead writes the encoding straight
+#   into the ring's payload arena, so the slower pure-Python path at least skips those copies.
+class BufferTooSmallError(ValueError):
+	"""Raised by bencodeInto() when the encoding does not fit in the buffer, as distinct from the
+		ValueErrors (such as UnicodeEncodeError) raised for values that can't be encoded at all."""
+
+
+def _put(buf:memoryview, off:int, data:bytes) -> int:
+	end:int = off + len(data)
+	if end > len(buf):
+		raise BufferTooSmallError("Buffer too small for the bencoded value.")
+	buf[off:end] = data
+	return end
+
+
+def bencodeInto(obj:int|str|bytes|list|tuple|dict, buf:memoryview, off:int=0) -> int:
+	"""Bencodes obj into buf starting at off, and returns the offset just past the encoding.
+		Raises BufferTooSmallError if it does not fit, in which case buf may have been partly
+		written. Like bencode(), raises TypeError for unsupported types and dict keys that aren't
+		str or bytes, and UnicodeEncodeError for strs that aren't valid UTF-8."""
+
+	if isinstance(obj, int):
+		return _put(buf, off, b'i%de' % obj)
+
+	if isinstance(obj, str):
+		obj = obj.encode()
+	if isinstance(obj, bytes):
+		return _put(buf, _put(buf, off, b'%d:' % len(obj)), obj)
+
+	if isinstance(obj, (list, tuple)):
+		off = _put(buf, off, b'l')
+		for item in obj:
+			off = bencodeInto(item, buf, off)
+		return _put(buf, off, b'e')
+
+	if isinstance(obj, dict):
+		# Keys must be byte strings, written in the sorted order of their raw bytes.
+		items:list[tuple[bytes,object]] = []
+		for k, v in obj.items():
+			if isinstance(k, str):
+				k = k.encode()
+			elif not isinstance(k, bytes):
+				raise TypeError(f"Cannot bencode {type(k).__name__} dict key.")
+			items.append((k, v))
+		items.sort(key=lambda item: item[0])
+
+		off = _put(buf, off, b'd')
+		for key, value in items:
+			off = bencodeInto(value, buf, bencodeInto(key, buf, off))
+		return _put(buf, off, b'e')
+
+	raise TypeError(f"Cannot bencode {type(obj).__name__}.")
+
+
+
+# ================================================================================================= Message Templates
+# DHT queries only vary in a few fixed-size fields, so rather than bencoding a whole dict for every
+#   query sent, each query type is bencoded once here with placeholder values, and the real values
+#   are spliced in between the constant pieces around them.
+_TID_LEN:int = 2
+_ID_LEN:int = 20
+_SENTINEL_TID:bytes = b'\xff' * _TID_LEN
+_SENTINEL_ID:bytes = b'\xfe' * _ID_LEN
+_SENTINEL_TARGET:bytes = b'\xfd' * _ID_LEN
+
+
+def _splitTemplate(template:bytes, *sentinels:bytes) -> tuple[bytes,...]:
+	"""Splits a bencoded template into the constant pieces around each of the given sentinel
+		values, which must appear in the template in the order given."""
+
+	pieces:list[bytes] = []
+	start:int = 0
+	for sentinel in sentinels:
+		pos:int = template.index(sentinel, start)
+		pieces.append(template[start:pos])
+		start = pos + len(sentinel)
+	pieces.append(template[start:])
+	return tuple(pieces)
+
+
+_FIND_NODE_PIECES:tuple[bytes,...] = _splitTemplate(
+	bencode({'t':_SENTINEL_TID, 'y':'q', 'q':'find_node', 'a':{'id':_SENTINEL_ID, 'target':_SENTINEL_TARGET}}),
+	_SENTINEL_ID, _SENTINEL_TARGET, _SENTINEL_TID,  # The order bencode's sorted keys put them in.
+)
+
+
+def buildFindNode(tid:bytes, node_id:bytes, target:bytes) -> bytes:
+	"""Returns a bencoded find_node query. tid must be 2 bytes long, and node_id and target must
+		be 20 bytes long, as the template's length prefixes are fixed."""
+
+	p0, p1, p2, p3 = _FIND_NODE_PIECES
+	return b''.join((p0, node_id, p1, target, p2, tid, p3))
 
 
 
 # ================================================================================================= Helper Structures
-# An Address is a remote hostname or IP, and port.
+# An Address is a remote hostname or IP, and port. Peers are sent to many times, so the
+#   kernel-ready sockaddr_in is built once up front, and the tuple form on first use. Addresses and
+#   Messages are created in large numbers, so both use __slots__ rather than a per-instance __dict__.
 class Address:
+	__slots__ = ('addr', 'port', '_sockaddr', '_tuple')
+
 	def __init__(self, addr:str, port:int) -> None:
 		self.addr:str = addr
 		self.port:int = port
+		self._tuple:tuple[str,int]|None = None
+
+		# Peers are almost always given as IP addresses, which can be packed directly; only fall
+		#   back to a lookup for hostnames.
+		packed:bytes
+		try:
+			packed = socket.inet_aton(addr)
+		except OSError:
+			packed = socket.inet_aton(socket.gethostbyname(addr))
+		self._sockaddr:bytes = struct.pack('=HH4s8x', socket.AF_INET, socket.htons(port), packed)
 
 
 	def asTuple(self) -> tuple[str,int]:
-		return (self.addr, self.port)
+		if self._tuple is None:
+			self._tuple = (self.addr, self.port)
+		return self._tuple
+
+
+	def asSockaddr(self) -> bytes:
+		"""Returns the Address as the raw bytes of a struct sockaddr_in."""
+		return self._sockaddr
 
 
 # A Message is a dict (that will be converted to a bencoded bytestring before sending) that is to
-#   be sent out to a given Address.
+#   be sent out to a given Address. The dict should not be modified once the Message has been
+#   encoded, as the encoding is cached.
 class Message:
-	def __init__(self, msg:dict, to:Address) -> None:
-		self.msg:dict = msg
+	__slots__ = ('msg', 'to', '_cached_enc')
+
+	def __init__(self, msg:dict|None, to:Address) -> None:
+		self.msg:dict|None = msg
 		self.to:Address = to
+		self._cached_enc:bytes|None = None
+
+
+	@classmethod
+	def fromTemplate(cls, template:bytes, to:Address) -> 'Message':
+		"""Creates a Message that sends an already-bencoded payload verbatim, for when the same
+			bytes are going out to many Addresses."""
+
+		msg:Message = cls(None, to)
+		msg._cached_enc = template
+		return msg
 
 
 	def encoded(self) -> bytes:
 		"""Returns the bencoded message, which is how DHT messages are required to be formatted."""
-		return bencode(self.msg)
+
+		if self._cached_enc is None:
+			self._cached_enc = bencode(self.msg)
+		return self._cached_enc
+
+
+	def payload(self) -> bytes|dict:
+		"""Returns what should be handed to the send queue: the encoded bytes if they are already
+			cached or the compiled encoder is available, or otherwise the dict itself, so that it
+			can be bencoded straight into the queue with bencodeInto()."""
+
+		if BENCODE_NATIVE or self._cached_enc is not None or self.msg is None:
+			return self.encoded()
+		return self.msg
+
+
+# A SendSlot is one entry of a SendRing: a queued datagram's iovec, which points at the slot's
+#   fixed region of the ring's payload arena, and its destination. It is padded to 64 bytes, and
+#   SendRing allocates its slots page-aligned, so that each slot has a cache line to itself.
+class SendSlot(ctypes.Structure):
+	_fields_ = [
+		('iov', Iovec),
+		('addr', SockaddrIn),
+		('_pad', ctypes.c_ubyte * (64 - ctypes.sizeof(Iovec) - ctypes.sizeof(SockaddrIn))),
+	]
+
+
+# A SendRing is a fixed-size, single-producer single-consumer queue of outgoing datagrams, laid out
+#   the way sendmmsg() consumes them. Each slot owns a fixed region of one preallocated payload
+#   arena and an mmsghdr already pointing at its iovec and address, so queueing a datagram only
+#   copies its bytes and sockaddr_in into the next slot, and the consumer hands runs of slots
+#   straight to the kernel.
+# It needs no locking because head is only ever written by the producer and tail only by the
+#   consumer. Both are 32-bit counters that wrap around, each on a page of its own so that the two
+#   sides never write to the same cache line; each side also keeps a cached copy of the other's
+#   index so that it only rereads it once its known window runs out.
+class SendRing:
+	def __init__(self, size:int) -> None:
+		assert size > 0 and size & (size - 1) == 0, "SendRing size must be a power of two."
+		self.size:int = size
+		self.mask:int = size - 1
+
+		self.arena:bytearray = bytearray(size * SEND_SLOT_SIZE)
+		self.arena_view:memoryview = memoryview(self.arena)
+		# ctypes arrays only get malloc()'s alignment, so the slots are laid out in an anonymous
+		#   mapping instead, which starts on a page boundary.
+		self.slots_page:mmap.mmap = mmap.mmap(-1, size * ctypes.sizeof(SendSlot))
+		self.slots:ctypes.Array[SendSlot] = (SendSlot * size).from_buffer(self.slots_page)
+		self.msghdrs:ctypes.Array[MMsgHdr] = (MMsgHdr * size)()
+		# Each slot's destination sockaddr_in and payload length, kept as Python objects too so that
+		#   the consumer can group slots without reading them back out of the ctypes structures.
+		self.dests:list[bytes] = [b''] * size
+		self.lens:list[int] = [0] * size
+
+		base:int = ctypes.addressof((ctypes.c_char * len(self.arena)).from_buffer(self.arena))
+		for i in range(size):
+			slot:SendSlot = self.slots[i]
+			slot.iov.iov_base = base + i * SEND_SLOT_SIZE
+			hdr:MsgHdr = self.msghdrs[i].msg_hdr
+			hdr.msg_name = ctypes.addressof(slot.addr)
+			hdr.msg_namelen = ctypes.sizeof(SockaddrIn)
+			hdr.msg_iov = ctypes.pointer(slot.iov)
+			hdr.msg_iovlen = 1
+
+		# Producer side.
+		self.head_page:mmap.mmap = mmap.mmap(-1, mmap.PAGESIZE)
+		self.head:ctypes.c_uint32 = ctypes.c_uint32.from_buffer(self.head_page)  # The number of datagrams ever pushed, modulo 2**32.
+		self.cached_tail:int = 0
+
+		# Consumer side.
+		self.tail_page:mmap.mmap = mmap.mmap(-1, mmap.PAGESIZE)
+		self.tail:ctypes.c_uint32 = ctypes.c_uint32.from_buffer(self.tail_page)  # The number of datagrams ever consumed, modulo 2**32.
+		self.cached_head:int = 0
+
+
+	def __len__(self) -> int:
+		return (self.head.value - self.tail.value) & 0xFFFFFFFF
+
+
+	def push(self, data:bytes, sockaddr:bytes) -> bool:
+		"""Copies a datagram's payload, which must be at most SEND_SLOT_SIZE bytes, and its
+			destination sockaddr_in into the next slot. Must only be called by the producer.
+			Returns False, without adding the datagram, if the ring is full."""
+
+		head:int = self.head.value
+		if (head - self.cached_tail) & 0xFFFFFFFF == self.size:
+			self.cached_tail = self.tail.value
+			if (head - self.cached_tail) & 0xFFFFFFFF == self.size:
+				return False
+
+		i:int = head & self.mask
+		off:int = i * SEND_SLOT_SIZE
+		length:int = len(data)
+		self.arena_view[off:off + length] = data
+
+		slot:SendSlot = self.slots[i]
+		slot.iov.iov_len = length
+		ctypes.memmove(ctypes.addressof(slot.addr), sockaddr, ctypes.sizeof(SockaddrIn))
+		self.dests[i] = sockaddr
+		self.lens[i] = length
+
+		self.head.value = head + 1  # Wraps around on overflow.
+		return True
+
+
+	def pushObject(self, obj:dict, sockaddr:bytes) -> bool:
+		"""Like push(), but bencodes obj directly into the next slot rather than copying in an
+			already-encoded payload. Raises BufferTooSmallError if the encoding is larger than
+			SEND_SLOT_SIZE bytes, or TypeError or ValueError if obj holds something that can't be
+			bencoded. In any case the ring is left unchanged, as head is only advanced once obj has
+			been encoded."""
+
+		head:int = self.head.value
+		if (head - self.cached_tail) & 0xFFFFFFFF == self.size:
+			self.cached_tail = self.tail.value
+			if (head - self.cached_tail) & 0xFFFFFFFF == self.size:
+				return False
+
+		i:int = head & self.mask
+		off:int = i * SEND_SLOT_SIZE
+		length:int = bencodeInto(obj, self.arena_view[off:off + SEND_SLOT_SIZE])
+
+		slot:SendSlot = self.slots[i]
+		slot.iov.iov_len = length
+		ctypes.memmove(ctypes.addressof(slot.addr), sockaddr, ctypes.sizeof(SockaddrIn))
+		self.dests[i] = sockaddr
+		self.lens[i] = length
+
+		self.head.value = head + 1  # Wraps around on overflow.
+		return True
+
+
+	def peek(self, limit:int) -> tuple[int,int]:
+		"""Returns the index of the oldest slot, and how many slots from it onwards (up to limit)
+			hold queued datagrams. The run stops at the end of the ring rather than wrapping, so
+			that its mmsghdrs are contiguous. Must only be called by the consumer."""
+
+		tail:int = self.tail.value
+		if tail == self.cached_head:
+			self.cached_head = self.head.value
+
+		idx:int = tail & self.mask
+		return idx, min((self.cached_head - tail) & 0xFFFFFFFF, self.size - idx, limit)
+
+
+	def advance(self, count:int) -> None:
+		"""Marks the oldest count datagrams as sent, freeing their slots. Must only be called by
+			the consumer."""
+
+		self.tail.value += count  # Wraps around on overflow.
+
+
+	def payload(self, i:int) -> memoryview:
+		"""Returns a view of the payload queued in slot i."""
+
+		off:int = i * SEND_SLOT_SIZE
+		return self.arena_view[off:off + self.lens[i]]
 
 
 
 # ================================================================================================= Class DHTServer
 class DHTServer:
-	def __init__(self, logger:Callable|None=None) -> None:
-		# Use a basic, built-in log function if none is provided.
-		self.log:Callable = logger if logger else self._log
-
-		# Set up a socket to listen for UDP packets on the configured port.
+	def __init__(self, logger:logging.Logger|None=None, cpus:set[int]|None=None, node_id:bytes|None=None, tids:itertools.count|None=None) -> None:
+		# Use the module's logger if none is provided. Log calls pass their arguments separately
+		#   rather than as f-strings, so that messages below the logger's level (notably the
+		#   per-packet debug messages) are never formatted.
+		self.log:logging.Logger = logger if logger else logging.getLogger(__name__)
+
+		# Check the arguments before any resources are acquired.
+		if node_id is not None and len(node_id) != _ID_LEN:
+			raise ValueError(f"Node ID must be {_ID_LEN} bytes long, not {len(node_id)}.")
+
+		# Set up a socket to listen for UDP packets on the configured port. SO_REUSEPORT lets
+		#   several DHTServers bind the same port, with the kernel spreading incoming flows between
+		#   them (see startServers()). Large kernel buffers absorb bursts between wakeups; the
+		#   kernel caps them at net.core.rmem_max/wmem_max.
 		self.sock:socket.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCK_KERNEL_BUF_SIZE)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCK_KERNEL_BUF_SIZE)
 		self.sock.bind(('0.0.0.0', PORT))
 
-		# Initialise the server's state.
-		self.running:bool = False  # Will be set to True once start() is called.
-		self.comms_thread:Thread|None = None  # Holds the thread handle for the server's actual communications component.
-		self.send_queue:Queue[Message] = Queue()  # A queue of messages to be sent out via UDP.
+		# Never block on the socket, so that a full send buffer can't stall receiving. DHT traffic
+		#   is best-effort anyway, so datagrams that can't be sent are dropped rather than waited on.
+		self.sock.setblocking(False)
 
-		# Create a recv/send socket pair. The send socket can signal the recv socket which will
-		#   indicate that there is data ready to send out via the main socket.
-		self.sig_recv:socket.socket;self.sig_send:socket.socket
-		self.sig_recv, self.sig_send = socket.socketpair()
+		# The CPUs to pin the communications thread to, ideally those handling the NIC's receive
+		#   queue interrupts. If None, the thread may run on any CPU.
+		self.cpus:set[int]|None = cpus
 
-
-	def _log(self, message:str, level:str='info') -> None:
-		"""A simple log function to be used when a more extensive logger is not in play."""
-		print(f"[{level}] {message}")
+		# Initialise the server's state. Servers sharing a port appear to peers as one node, so
+		#   they must also share its ID and a transaction ID source (see startServers()).
+		self.node_id:bytes = node_id if node_id else os.urandom(_ID_LEN)  # This node's ID in the DHT.
+		self.tids:itertools.count = tids if tids else itertools.count()  # Source of query transaction IDs. Safe to share between threads.
+		self.running:bool = False  # Will be set to True once start() is called.
+		self.comms_thread:Thread|None = None  # Holds the thread handle for the server's actual communications component.
+		self.send_ring:SendRing = SendRing(SEND_RING_SIZE)  # A queue of datagrams to be sent out via UDP.
+		self.send_lock:Lock = Lock()  # Serialises the producers of the send queue, which only supports one at a time.
+		self.tx_dropped:int = 0  # The number of datagrams dropped because the send queue was full. Updated under send_lock.
+		self.tx_send_dropped:int = 0  # The number of queued datagrams dropped because the socket buffer was full. Only updated by the communications thread, so that it never waits on send_lock.
+
+		# Incoming messages are decoded and handled on a pool of worker threads, so that a slow
+		#   message never holds up the communications thread's socket I/O. Every batch waiting for
+		#   a worker holds on to its receive slots, so the fixed slot pool also bounds the backlog.
+		self.process_pool:ThreadPoolExecutor = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='dht-process')
+
+		# Create an eventfd to be used as a signal that there is data ready to send out via the
+		#   main socket. Writes to it add to a single counter, so any number of signals sent before
+		#   the communications thread wakes up are cleared by one read.
+		self.sig_fd:int = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+
+		# Register both with an epoll instance up front, rather than handing select() a fresh list
+		#   of them to scan on every wakeup. The main socket is also watched for writability, but
+		#   only while there are Messages waiting to be sent, as it is nearly always writable.
+		self.epoll:select.epoll = select.epoll()
+		self.epoll.register(self.sock.fileno(), select.EPOLLIN)
+		self.epoll.register(self.sig_fd, select.EPOLLIN)
+		self.send_armed:bool = False  # Whether the main socket is currently registered for EPOLLOUT.
+
+		# Preallocate headers for sending whatever is left of a run of queued datagrams once some
+		#   of them have been sent with a segmentation offload.
+		self.send_scratch:ctypes.Array[MMsgHdr] = (MMsgHdr * SEND_BATCH_SIZE)()
+		self.gso_enabled:bool = True  # Cleared if the kernel or device turns out not to support UDP_SEGMENT.
+
+		# Preallocate a pool of receive buffers ("slots"). Datagrams are read straight into a slot,
+		#   which is then lent to a processing thread as a memoryview and handed back to the free
+		#   list once the message has been handled. deque appends and pops are atomic, so the
+		#   processing threads can return slots without a lock.
+		self.rx_slots:list[bytearray] = []
+		self.rx_slot_ptrs:list[int] = []  # The address of each slot's buffer, for the iovecs.
+		self.rx_free:deque[int] = deque()  # Indexes of the slots not currently lent out.
+		for _ in range(RECV_SLOT_COUNT):
+			self._addRecvSlot()
+
+		# While every slot is lent out, headers read into a shared scratch buffer instead, and
+		#   whatever lands there is dropped, so that the processing threads falling behind can't
+		#   grow the pool or the queue of batches waiting for them without limit.
+		self.rx_scratch:bytearray = bytearray(SOCK_RECV_BUF_SIZE)
+		self.rx_scratch_ptr:int = ctypes.addressof((ctypes.c_char * SOCK_RECV_BUF_SIZE).from_buffer(self.rx_scratch))
+		self.rx_dropped:int = 0  # The number of datagrams dropped because no receive slot was free.
+
+		# Preallocate the headers used for batched receives. Each mmsghdr points at its own iovec
+		#   and sockaddr_in, and each iovec is kept armed with a free slot.
+		self.recv_iovecs:ctypes.Array[Iovec] = (Iovec * RECV_BATCH_SIZE)()
+		self.recv_addrs:ctypes.Array[SockaddrIn] = (SockaddrIn * RECV_BATCH_SIZE)()
+		self.recv_hdrs:ctypes.Array[MMsgHdr] = (MMsgHdr * RECV_BATCH_SIZE)()
+		self.recv_hdr_slots:list[int] = [0] * RECV_BATCH_SIZE  # Which slot each header is reading into, or -1 for the scratch buffer.
+		for i in range(RECV_BATCH_SIZE):
+			self.recv_iovecs[i].iov_len = SOCK_RECV_BUF_SIZE
+			hdr:MsgHdr = self.recv_hdrs[i].msg_hdr
+			hdr.msg_name = ctypes.addressof(self.recv_addrs[i])
+			hdr.msg_iov = ctypes.pointer(self.recv_iovecs[i])
+			hdr.msg_iovlen = 1
+			self._armRecvHeader(i)
 
 
 	def commsLoop(self) -> None:
 		"""Loops forever, listening for incoming UDP datagrams and processing them, and sending
 			out queued messages."""
 
-		while self.running:
-			# Wait for either the main socket to receive data, or for the signal socket to receive
-			#   data, which indicates that there is a Message available in the queue to send out.
-			ready_sockets:list[socket.socket]
-			ready_sockets, _, _ = select.select([self.sock, self.sig_recv], [], [])
-
-			for rs in ready_sockets:
-				# If the main socket has received data, process the incoming message.
-				if rs is self.sock:
-					data:bytes;addr:tuple
-					data, addr = self.sock.recvfrom(SOCK_RECV_BUF_SIZE)
-
-					# Log the received message for debug purposes.
-					self.log(f"Received data from {addr}: {data}", 'debug')
-
-					#TODO self.processMessage(bdecode(data))
+		sock_fd:int = self.sock.fileno()
 
-				# Otherwise, if the signal socket has received data, that means there is a Message
-				#   in the queue ready to send out.
-				elif rs is self.sig_recv:
-					self.sig_recv.recv(1)
-
-					msg:Message = self.send_queue.get()
-					self.log(f"Sending Message to {msg.to.asTuple()}: {msg.msg}", 'debug')
-					self.sock.sendto(msg.encoded(), msg.to.asTuple())
+		while self.running:
+			# Wait for the main socket to receive data or become writable, or for the signal
+			#   eventfd to be written, which indicates that there is a Message available in the
+			#   queue to send out.
+			ready:list[tuple[int,int]] = self.epoll.poll()
+
+			for fd, events in ready:
+				if fd == sock_fd:
+					# If the main socket has received data, process the incoming messages.
+					if events & select.EPOLLIN:
+						self.recvAll()
+
+					# If it has room to send, drain the send queue, and stop watching for
+					#   writability once it is empty.
+					if events & select.EPOLLOUT:
+						if self.sendAll():
+							self._setSendArmed(False)
+
+				# Otherwise, if the signal eventfd has been written, that means there is a Message
+				#   in the queue ready to send out once the main socket is writable.
+				elif fd == self.sig_fd:
+					os.eventfd_read(self.sig_fd)  # Resets the signal counter to zero.
+					self._setSendArmed(True)
+
+
+	def _setSendArmed(self, armed:bool) -> None:
+		"""Starts or stops watching the main socket for writability."""
+
+		if armed != self.send_armed:
+			self.epoll.modify(self.sock.fileno(), (select.EPOLLIN | select.EPOLLOUT) if armed else select.EPOLLIN)
+			self.send_armed = armed
+
+
+	def recvAll(self) -> None:
+		"""Reads the datagrams currently waiting on the main socket, up to RECV_MAX_BATCHES
+			recvmmsg() calls' worth, so that a burst of incoming packets costs a single wakeup
+			rather than one per packet. The datagrams are passed on to the processing threads in
+			batches of PROCESS_BATCH_SIZE. Anything left over is picked up on the next wakeup, as
+			the socket is watched level-triggered, once any pending sends have had a turn."""
+
+		fd:int = self.sock.fileno()
+		batch:list[tuple[int,int,tuple[str,int]]] = []
+
+		# Headers left on the scratch buffer the last time the pool ran dry are moved back onto
+		#   real slots as soon as any have been returned.
+		if self.rx_free and -1 in self.recv_hdr_slots:
+			for i in range(RECV_BATCH_SIZE):
+				if self.recv_hdr_slots[i] < 0:
+					self._armRecvHeader(i)
+
+		for _ in range(RECV_MAX_BATCHES):
+			# The socket is non-blocking, so this loop stops early as soon as the kernel's receive
+			#   queue is empty.
+			count:int = libc.recvmmsg(fd, self.recv_hdrs, RECV_BATCH_SIZE, socket.MSG_DONTWAIT, None)
+			if count < 0:
+				errno:int = ctypes.get_errno()
+				if errno not in (EAGAIN, EINTR):
+					self.log.error("recvmmsg() failed: %s", os.strerror(errno))
+				count = 0
+
+			for i in range(count):
+				hdr:MMsgHdr = self.recv_hdrs[i]
+				slot:int = self.recv_hdr_slots[i]
+				sa:SockaddrIn = self.recv_addrs[i]
+				addr:tuple[str,int] = (socket.inet_ntoa(bytes(sa.sin_addr)), socket.ntohs(sa.sin_port))
+
+				# A datagram read into the scratch buffer has nowhere to go, so it is dropped, and
+				#   the header is pointed back at a real slot if one has been returned since.
+				if slot < 0:
+					self.rx_dropped += 1
+					self._armRecvHeader(i)
+
+				# Anything too big for a slot has been cut short, and cannot be a valid message, so
+				#   the header can keep reading into the same slot.
+				elif hdr.msg_hdr.msg_flags & socket.MSG_TRUNC:
+					self.log.debug("Dropping oversized datagram from %s.", addr)
+				else:
+					batch.append((slot, hdr.msg_len, addr))
+					self._armRecvHeader(i)
+					if len(batch) == PROCESS_BATCH_SIZE:
+						self._submitBatch(batch)
+						batch = []
+
+				# The kernel overwrites each name length with the size of the address it wrote.
+				hdr.msg_hdr.msg_namelen = ctypes.sizeof(SockaddrIn)
+
+			# A short batch means the receive queue has been emptied.
+			if count < RECV_BATCH_SIZE:
+				break
+
+		if batch:
+			self._submitBatch(batch)
+
+
+	def _submitBatch(self, batch:list[tuple[int,int,tuple[str,int]]]) -> None:
+		"""Hands a batch of received datagrams to the processing threads. The pool refuses new
+			work once the interpreter starts shutting down (for instance when the main thread of a
+			program that only called start() returns), in which case the batch is dropped and the
+			server stops, rather than the communications thread dying on the error."""
+
+		try:
+			self.process_pool.submit(self._processSlots, batch)
+		except RuntimeError:
+			self.rx_free.extend(slot for slot, _, _ in batch)
+			if self.running:
+				self.log.info('Processing thread pool has shut down, stopping DHT server.')
+				self.running = False
+
+
+	def _addRecvSlot(self) -> None:
+		"""Adds a new receive buffer to the pool, and marks it as free."""
+
+		buf:bytearray = bytearray(SOCK_RECV_BUF_SIZE)
+		self.rx_slots.append(buf)
+		self.rx_slot_ptrs.append(ctypes.addressof((ctypes.c_char * SOCK_RECV_BUF_SIZE).from_buffer(buf)))
+		self.rx_free.append(len(self.rx_slots) - 1)
+
+
+	def _armRecvHeader(self, i:int) -> None:
+		"""Points a receive header at a free slot, or at the scratch buffer if every slot is lent
+			out, so that datagrams are still drained from the kernel's receive queue."""
+
+		if self.rx_free:
+			slot:int = self.rx_free.popleft()
+			self.recv_hdr_slots[i] = slot
+			self.recv_iovecs[i].iov_base = self.rx_slot_ptrs[slot]
+		else:
+			self.recv_hdr_slots[i] = -1
+			self.recv_iovecs[i].iov_base = self.rx_scratch_ptr
+		self.recv_hdrs[i].msg_hdr.msg_namelen = ctypes.sizeof(SockaddrIn)
+
+
+	def _processSlots(self, batch:list[tuple[int,int,tuple[str,int]]]) -> None:
+		"""Processes a batch of datagrams, given as (receive slot, length, sender) tuples, in one
+			go, returning each slot to the free list as it is finished with. Any replies are only
+			queued once the whole batch has been handled, so they cost a single wakeup of the
+			communications thread."""
+
+		replies:list[Message] = []
+		for slot, length, addr in batch:
+			data:memoryview = memoryview(self.rx_slots[slot])[:length]
+			try:
+				self.processMessage(data, addr, replies)
+			except Exception:
+				self.log.exception("Failed to process datagram from %s.", addr)
+			finally:
+				data.release()
+				self.rx_free.append(slot)
+
+		if replies:
+			try:
+				self.sendMessages(replies)
+			except Exception:
+				self.log.exception("Failed to queue %d replies.", len(replies))
+
+
+	def processMessage(self, data:bytes|memoryview, addr:tuple[str,int], replies:list[Message]) -> None:
+		"""Decodes and handles a single incoming datagram, adding any Messages to be sent in
+			response to replies. Runs on the processing thread pool."""
+
+		# Datagrams come from arbitrary peers, so anything the decoder rejects is simply invalid.
+		#   Besides BTFailure, the compiled decoder raises SystemError or MemoryError on some
+		#   truncated input, and deeply nested input can exhaust the stack. The pure-Python
+		#   decoder can only index bytes, so the slot's memoryview is copied for it.
+		try:
+			msg:dict = bdecode(data if BENCODE_NATIVE else bytes(data))
+		except (BTFailure, SystemError, MemoryError, RecursionError):
+			if self.log.isEnabledFor(logging.DEBUG):
+				self.log.debug("Received invalid bencoded data from %s: %r", addr, bytes(data))
+			return
+
+		# Log the received message for debug purposes.
+		self.log.debug("Received data from %s: %s", addr, msg)
+
+		#TODO Handle the message, adding any responses to replies.
+
+
+	def sendAll(self) -> bool:
+		"""Drains the send queue, handing the queued datagrams to the kernel in batches of up to
+			SEND_BATCH_SIZE datagrams per sendmmsg() call. Returns True once the queue is empty, or
+			False if the kernel's send buffer filled up first, in which case the unsent datagrams
+			are left queued to be retried once the socket is writable again."""
+
+		ring:SendRing = self.send_ring
+
+		while True:
+			idx:int;count:int
+			idx, count = ring.peek(SEND_BATCH_SIZE)
+			if count == 0:
+				return True
+
+			# Datagrams that can be coalesced are sent with a segmentation offload. The rest are
+			#   sent straight from the ring's headers if that was none of them, or otherwise from a
+			#   copy of the remaining headers.
+			rest:list[int]|None = self._sendSegmented(idx, count) if self.gso_enabled and count > 1 else None
+			if rest is None or len(rest) == count:
+				sent:int = self._sendHeaders(ring.msghdrs, idx, count)
+				ring.advance(sent)
+				if sent < count:
+					return False
+
+			else:
+				# Only a contiguous run at the front of the ring can be left queued, so if the
+				#   kernel pushes back on a scattered remainder, drop what is left of it.
+				sent = 0
+				if rest:
+					for j, i in enumerate(rest):
+						self.send_scratch[j] = ring.msghdrs[i]
+					sent = self._sendHeaders(self.send_scratch, 0, len(rest))
+					if sent < len(rest):
+						self.tx_send_dropped += len(rest) - sent
+
+				ring.advance(count)
+				if sent < len(rest):
+					return False
+
+
+	def _sendSegmented(self, idx:int, count:int) -> list[int]:
+		"""Sends each group of equal-sized datagrams to the same destination, among the count
+			queued from slot idx, as a single UDP_SEGMENT send, which the kernel splits back into
+			individual datagrams. Returns the slots that were not sent this way."""
+
+		ring:SendRing = self.send_ring
+		groups:dict[tuple[bytes,int],list[int]] = {}
+		for i in range(idx, idx + count):
+			groups.setdefault((ring.dests[i], ring.lens[i]), []).append(i)
+
+		# Commonly every datagram is going somewhere different, so there is nothing to coalesce.
+		if len(groups) == count:
+			return list(range(idx, idx + count))
+
+		rest:list[int] = []
+		for (dest, seg_len), slots in groups.items():
+			# Empty datagrams can't be segmented, and a lone datagram gains nothing from it.
+			if seg_len == 0 or len(slots) < 2:
+				rest.extend(slots)
+				continue
+
+			per_send:int = min(GSO_MAX_SEGMENTS, GSO_MAX_BYTES // seg_len)
+			for i in range(0, len(slots), per_send):
+				chunk:list[int] = slots[i:i + per_send]
+				if len(chunk) < 2 or not self.gso_enabled:
+					rest.extend(chunk)
+					continue
+
+				to:tuple[str,int] = (socket.inet_ntoa(dest[4:8]), int.from_bytes(dest[2:4], 'big'))
+				try:
+					self.sock.sendmsg([b''.join(ring.payload(j) for j in chunk)], [(socket.SOL_UDP, UDP_SEGMENT, struct.pack('=H', seg_len))], 0, to)
+				except OSError as e:
+					# EIO means the outgoing device can't checksum segmented sends, which won't
+					#   change, so stop trying. Other errors (such as a segment too large for the
+					#   MTU) only affect this group. Either way, fall back to sending normally.
+					if e.errno == EIO:
+						self.log.warning('UDP segmentation offload is unsupported, disabling it.')
+						self.gso_enabled = False
+					rest.extend(chunk)
+
+		return rest
+
+
+	def _sendHeaders(self, hdrs:ctypes.Array[MMsgHdr], start:int, count:int) -> int:
+		"""Sends the datagrams described by count headers from hdrs[start], skipping past any that
+			the kernel rejects so that one bad destination cannot hold up the rest of the batch.
+			Returns how many were dealt with, which is less than count if the kernel's send
+			buffer filled up."""
+
+		fd:int = self.sock.fileno()
+		sent:int = 0
+		while sent < count:
+			n:int = libc.sendmmsg(fd, ctypes.byref(hdrs, (start + sent) * ctypes.sizeof(MMsgHdr)), count - sent, 0)
+			if n < 0:
+				errno:int = ctypes.get_errno()
+				if errno == EINTR:
+					continue
+				if errno in (EAGAIN, EWOULDBLOCK):
+					return sent
+
+				# sendmmsg() only reports an error for the first datagram of the call, so skip it.
+				sa:SockaddrIn = SockaddrIn.from_address(hdrs[start + sent].msg_hdr.msg_name)
+				self.log.error("Failed to send to %s:%d: %s", socket.inet_ntoa(bytes(sa.sin_addr)), socket.ntohs(sa.sin_port), os.strerror(errno))
+				n = 1
+			sent += n
+		return sent
 
 
 	def start(self) -> None:
@@ -107,24 +805,145 @@ class DHTServer:
 
 		self.running = True
 
+		if not BENCODE_NATIVE:
+			self.log.warning('The compiled bencode extension is unavailable, falling back to the much slower pure-Python encoder.')
+
 		self.comms_thread = Thread(target=self.commsLoop)
 		self.comms_thread.start()
-		self.log('Started DHT server communications thread.', 'info')
+		if self.cpus is not None:
+			os.sched_setaffinity(self.comms_thread.native_id, self.cpus)
+		self.log.info('Started DHT server communications thread.')
 
 
-	def sendMessage(self, msg:Message) -> None:
-		"""Adds the provided Message to the send queue and then sends a signal to process the
-			queue."""
+	def findNode(self, to:Address, target:bytes) -> None:
+		"""Sends a find_node query for the given 20-byte target ID to an Address. Raises
+			ValueError if target is any other length, as the query template can't encode it."""
 
-		self.send_queue.put(msg)
+		if len(target) != _ID_LEN:
+			raise ValueError(f"find_node target must be {_ID_LEN} bytes long, not {len(target)}.")
 
-		# Send a single byte of data through the signal send socket to wake up the main
-		#   communications thread, which will then process the send queue.
-		self.sig_send.send(b'\x00')
+		tid:bytes = (next(self.tids) & 0xFFFF).to_bytes(_TID_LEN, 'big')
+		if self.log.isEnabledFor(logging.DEBUG):
+			self.log.debug("Sending find_node for %s to %s", target.hex(), to.asTuple())
+		self.sendBytes(buildFindNode(tid, self.node_id, target), to)
+
+
+	def sendMessage(self, msg:Message) -> None:
+		"""Bencodes the provided Message and adds it to the send queue. Safe to call from any
+			thread."""
+
+		self.sendMessages([msg])
+
+
+	def sendMessages(self, msgs:list[Message]) -> None:
+		"""Bencodes the provided Messages and adds them all to the send queue at once. A Message
+			that can't be bencoded is logged and dropped without affecting the rest. Safe to call
+			from any thread."""
+
+		datagrams:list[tuple[bytes|dict,Address]] = []
+		for msg in msgs:
+			try:
+				payload:bytes|dict = msg.payload()
+			except (TypeError, ValueError) as e:
+				self.log.error("Message to %s can't be bencoded, dropping it: %s", msg.to.asTuple(), e)
+				continue
+			self.log.debug("Sending Message to %s: %s", msg.to.asTuple(), payload if msg.msg is None else msg.msg)
+			datagrams.append((payload, msg.to))
+		self._queueDatagrams(datagrams)
+
+
+	def sendBytes(self, data:bytes, to:Address) -> None:
+		"""Adds an already-bencoded payload to the send queue. Safe to call from any thread."""
+
+		self._queueDatagrams([(data, to)])
+
+
+	def _queueDatagrams(self, datagrams:list[tuple[bytes|dict,Address]]) -> None:
+		"""Adds (payload, destination) pairs to the send queue, signalling the communications
+			thread whenever one goes into an empty queue. Payloads are either bencoded bytes, or dicts to be bencoded
+			directly into the queue."""
+
+		ready:list[tuple[bytes|dict,bytes]] = []
+		for payload, to in datagrams:
+			if isinstance(payload, bytes) and len(payload) > SEND_SLOT_SIZE:
+				self.log.error("Message to %s is larger than %d bytes, dropping it.", to.asTuple(), SEND_SLOT_SIZE)
+			else:
+				ready.append((payload, to.asSockaddr()))
+
+		dropped:int = 0
+		with self.send_lock:
+			for payload, sockaddr in ready:
+				pushed:bool
+				if isinstance(payload, bytes):
+					pushed = self.send_ring.push(payload, sockaddr)
+				else:
+					try:
+						pushed = self.send_ring.pushObject(payload, sockaddr)
+					except BufferTooSmallError:
+						self.log.error("Message to %s:%d is larger than %d bytes, dropping it.", socket.inet_ntoa(sockaddr[4:8]), int.from_bytes(sockaddr[2:4], 'big'), SEND_SLOT_SIZE)
+						continue
+					except (TypeError, ValueError) as e:
+						self.log.error("Message to %s:%d can't be bencoded, dropping it: %s", socket.inet_ntoa(sockaddr[4:8]), int.from_bytes(sockaddr[2:4], 'big'), e)
+						continue
+
+				if not pushed:
+					dropped += 1
+					continue
+
+				# The communications thread only waits for a signal once it has found the queue
+				#   empty, so one is only needed if a datagram went into an empty queue. It is sent
+				#   straight away, rather than once the whole call is queued, so that the queue
+				#   starts draining while the rest of a large burst is still being added.
+				if len(self.send_ring) == 1:
+					os.eventfd_write(self.sig_fd, 1)
+
+			self.tx_dropped += dropped
+
+		# Report drops once per call, outside the lock, as a flood would otherwise log (and format
+		#   an address for) every datagram while holding up the other producers.
+		if dropped:
+			self.log.warning("Send queue full, dropped %d of %d datagrams.", dropped, len(ready))
+
+
+
+# ================================================================================================= Functions
+def startServers(count:int, logger:logging.Logger|None=None, cpus:list[set[int]]|None=None) -> list[DHTServer]:
+	"""Starts count DHTServers sharing the configured port, letting the kernel spread incoming
+		traffic across them so that receiving scales over multiple cores. If given, cpus holds the
+		CPUs to pin each server's communications thread to.
+	Peers see a single node on the port, and a reply may be delivered to a different server than
+		the one that sent the query, so the servers share one node ID and one transaction ID
+		source, keeping transaction IDs unique across all of them."""
+
+	node_id:bytes = os.urandom(_ID_LEN)
+	tids:itertools.count = itertools.count()
+
+	servers:list[DHTServer] = []
+	for i in range(count):
+		server:DHTServer = DHTServer(logger, cpus[i] if cpus else None, node_id, tids)
+		server.start()
+		servers.append(server)
+	return servers
 
 
 
 #TODO: The following is temporary test code.
-dht_serv:DHTServer = DHTServer()
-dht_serv.start()
-dht_serv.sendMessage(Message({'msg':'test'}, Address('127.0.0.1', 6881)))
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.DEBUG, format='[%(levelname)s] %(message)s')
+
+	# Check bencodeInto() against fast-bencode's pure-Python reference encoder. Its dict keys are
+	#   all ASCII, as the reference writes a str key's length in characters rather than bytes.
+	from bencode.bencode import bencode as reference_bencode
+	check_buf:bytearray = bytearray(SEND_SLOT_SIZE)
+	for value in (0, -42, 2**70, '', 'caf\u00e9', b'\x00\xff', [], [1, 'a', b'b', [2, ['c']]], {},
+			{'y':'q', 'a':{'id':b'\x01' * 20, 'target':b'\x02' * 20}, 't':b'aa', 'q':'find_node'},
+			{'b':{'z':[{}, {'k':b''}], 'x':-1}, 'a':[{'n':0}]}):
+		check_len:int = bencodeInto(value, memoryview(check_buf))
+		assert check_buf[:check_len] == reference_bencode(value), f"bencodeInto() mismatch for {value!r}"
+
+	dht_serv:DHTServer = DHTServer()
+	dht_serv.start()
+	dht_serv.sendMessage(Message({'msg':'test'}, Address('127.0.0.1', 6881)))
+
+	# Keep the main thread alive, as the processing thread pool stops accepting work once it exits.
+	dht_serv.comms_thread.join()